@@ -1,198 +1,427 @@
-import pandas as pd
-import tabula
-import sqlite3
 from pathlib import Path
 import logging
+import logging.handlers
 import sys
 import os
+import queue
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from contextlib import nullcontext
+from operator import itemgetter
 
-# Set up logging
-os.makedirs('/app/logs', exist_ok=True)
-logging.basicConfig(
-    level=logging.DEBUG,
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler('/app/logs/parser_debug.log'),
-        logging.StreamHandler(sys.stdout)
-    ]
-)
+LOG_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
 
-def extract_karaoke_data(pdf_path, start_page=1, end_page=None):
+def setup_logging():
     """
-    Extract karaoke song data from PDF with detailed debugging
+    Log to stdout and to the debug log file; file writes are buffered and
+    flushed in batches
     """
-    logging.info(f"Starting extraction from {pdf_path}")
+    os.makedirs('/app/logs', exist_ok=True)
+    file_handler = logging.FileHandler('/app/logs/parser_debug.log')
+    file_handler.setFormatter(logging.Formatter(LOG_FORMAT))
+    logging.basicConfig(
+        level=logging.INFO,
+        format=LOG_FORMAT,
+        handlers=[
+            logging.handlers.MemoryHandler(capacity=1000, target=file_handler),
+            logging.StreamHandler(sys.stdout)
+        ]
+    )
+
+def flush_logs():
+    """
+    Push buffered log records out to their targets
+    """
+    for handler in logging.getLogger().handlers:
+        handler.flush()
+
+# Every page carries the same 5-column table, but only the shaded rows
+# draw cell borders, so the column lines are measured per page
+TABLE_SETTINGS = {
+    "vertical_strategy": "explicit",
+    "horizontal_strategy": "lines"
+}
+
+COLUMNS = ['Interprete', 'Cod', 'Titulo', 'Inicio da letra', 'Idioma']
+
+def extract_page_tables(page):
+    """
+    Extract the song table from one page, taking the column boundaries
+    from the gaps in the table's top rule (one segment per column); the
+    column widths differ from page to page
+    """
+    rules = [line for line in page.lines if abs(line['top'] - line['bottom']) < 1]
+    borders = [line for line in page.lines if abs(line['x0'] - line['x1']) < 1]
+    if not rules or not borders:
+        raise ValueError("No table borders found")
     
-    all_dataframes = []
-    failed_pages = []
+    top = min(line['top'] for line in borders)
+    bottom = max(line['bottom'] for line in borders)
+    segments = sorted((line for line in rules if abs(line['top'] - top) < 1), key=itemgetter('x0'))
     
-    # If end_page is not specified, try to process all pages
-    if end_page is None:
-        try:
-            # Get total number of pages
-            tables = tabula.read_pdf(
-                pdf_path,
-                pages='all',
-                multiple_tables=False,  # Changed to False
-                lattice=True
-            )
-            end_page = 316  # Hardcoded for now
-            logging.info(f"Processing {end_page} pages in PDF")
-        except Exception as e:
-            logging.error(f"Error detecting total pages: {str(e)}")
-            end_page = 316
+    x_lines = [segments[0]['x0']]
+    x_lines += [(left['x1'] + right['x0']) / 2 for left, right in zip(segments, segments[1:])]
+    x_lines.append(segments[-1]['x1'])
+    if len(x_lines) != len(COLUMNS) + 1:
+        raise ValueError(f"Expected {len(COLUMNS) + 1} column lines, got {len(x_lines)}")
+    
+    # Crop to the table so the title block above it isn't read as a row
+    table_area = page.crop((x_lines[0] - 1, top - 1, x_lines[-1] + 1, bottom + 1))
+    return table_area.extract_tables(
+        table_settings=dict(TABLE_SETTINGS, explicit_vertical_lines=x_lines)
+    )
+
+# Document kept open for the lifetime of a worker process
+_worker_pdf = None
 
-    # Process pages one at a time to better handle issues
-    for page_num in range(start_page, end_page + 1):
-        logging.info(f"Processing page {page_num}")
+def _open_worker_pdf(pdf_path):
+    """
+    Open the PDF once per worker process so every chunk it handles reuses
+    the same parsed document
+    """
+    import pdfplumber
+    global _worker_pdf
+    
+    _worker_pdf = pdfplumber.open(pdf_path)
+
+def _extract_chunk(pdf_path, chunk_start, chunk_end):
+    """
+    Extract the tables for one page range; runs in a worker process
+    """
+    import pandas as pd
+    import pdfplumber
+    
+    logging.debug(f"Processing pages {chunk_start}-{chunk_end}")
+    
+    rows = []
+    page_col = []
+    failed_pages = []
+    
+    # Reuse the worker's open document when there is one
+    if _worker_pdf is not None:
+        pdf_context = nullcontext(_worker_pdf)
+    else:
+        pdf_context = pdfplumber.open(pdf_path)
+    
+    with pdf_context as pdf:
+        pages = pdf.pages[chunk_start - 1:chunk_end]
         
-        try:
-            # Modified parameters for better table detection
-            tables = tabula.read_pdf(
-                pdf_path,
-                pages=str(page_num),
-                multiple_tables=False,  # Changed to False
-                lattice=True,
-                guess=True,  # Enable layout guessing
-                pandas_options={
-                    'header': None,
-                    'error_bad_lines': False,
-                    'warn_bad_lines': True
-                }
-            )
+        for page_num, page in enumerate(pages, start=chunk_start):
+            logging.debug(f"Processing page {page_num}")
             
-            if not isinstance(tables, list):
-                tables = [tables]
+            # Only the extraction itself can fail; rows are validated in
+            # bulk once the chunk is assembled
+            try:
+                tables = extract_page_tables(page)
+            except Exception as e:
+                logging.error(f"Error processing page {page_num}: {str(e)}")
+                failed_pages.append(page_num)
+                continue
+            finally:
+                # Release the page's parsed objects; the document itself
+                # stays open for the worker's next chunk
+                page.flush_cache()
             
-            for table in tables:
-                try:
-                    if table.empty:
-                        logging.warning(f"Empty table on page {page_num}")
-                        failed_pages.append(page_num)
-                        continue
-                    
-                    # Ensure correct number of columns
-                    if len(table.columns) != 5:
-                        # Try to fix column issues
-                        if len(table.columns) > 5:
-                            table = table.iloc[:, :5]  # Take first 5 columns
-                        else:
-                            logging.warning(f"Wrong number of columns on page {page_num}: {len(table.columns)}")
-                            failed_pages.append(page_num)
-                            continue
-                    
-                    # Drop header row if it exists
-                    if 'Interprete' in str(table.iloc[0]) or 'Cod' in str(table.iloc[0]):
-                        table = table.iloc[1:]
-                    
-                    # Assign column names
-                    table.columns = ['Interprete', 'Cod', 'Titulo', 'Inicio da letra', 'Idioma']
-                    
-                    # Clean up data
-                    table = table.fillna('')
-                    for col in table.columns:
-                        table[col] = table[col].astype(str).str.strip()
-                    
-                    # Add page number
-                    table['Page'] = page_num
-                    
-                    # Basic validation
-                    if len(table) > 0:
-                        all_dataframes.append(table)
-                        logging.info(f"Successfully processed page {page_num} with {len(table)} rows")
-                    else:
-                        logging.warning(f"No valid data on page {page_num}")
-                        failed_pages.append(page_num)
-                    
-                except Exception as e:
-                    logging.error(f"Error processing table on page {page_num}: {str(e)}")
+            if not tables:
+                logging.warning(f"No table found on page {page_num}")
+                failed_pages.append(page_num)
+                continue
+            
+            for tbl in tables:
+                if not tbl or len(tbl[0]) < 5:
+                    logging.warning(f"Empty table or wrong number of columns on page {page_num}")
                     failed_pages.append(page_num)
-                    
-        except Exception as e:
-            logging.error(f"Error processing page {page_num}: {str(e)}")
-            failed_pages.append(page_num)
+                    continue
+                
+                # Keep the raw rows (first 5 columns); one DataFrame is
+                # built and cleaned per chunk
+                rows.extend(row[:5] for row in tbl)
+                page_col.extend([page_num] * len(tbl))
+                logging.debug(f"Extracted {len(tbl)} rows from page {page_num}")
     
-    if not all_dataframes:
-        raise Exception("No data was successfully extracted")
+    # Clean up data in one pass over the chunk's columns
+    frame = pd.DataFrame(rows, columns=COLUMNS)
+    frame['Page'] = page_col
+    frame[COLUMNS] = frame[COLUMNS].fillna('').astype(str).apply(lambda s: s.str.strip())
     
-    # Combine all successful extractions
-    df = pd.concat(all_dataframes, ignore_index=True)
+    # Drop repeated header rows, the closing song-count row and rows
+    # whose code isn't a number in one pass; code keys karaoke_songs, so
+    # a mis-read row must never reach the insert
+    is_header = frame['Interprete'].eq('Interprete') | frame['Cod'].str.startswith('Cod')
+    is_header |= frame['Interprete'].str.startswith('Total de')
+    valid_code = frame['Cod'].str.fullmatch(r'\d+')
     
-    # Save debug CSV to data directory
-    os.makedirs('/app/data', exist_ok=True)
-    df.to_csv('/app/data/extracted_data_debug.csv', index=False)
+    invalid = frame[~is_header & ~valid_code]
+    failed_rows = list(invalid[['Page', 'Interprete', 'Cod']].itertuples(index=False, name=None))
+    if failed_rows:
+        invalid_pages = sorted(set(invalid['Page']))
+        logging.warning(f"Dropped {len(failed_rows)} rows without a valid code on pages {invalid_pages}")
+        failed_pages.extend(invalid_pages)
     
-    # Log summary
-    logging.info(f"Extraction complete:")
-    logging.info(f"Total rows extracted: {len(df)}")
-    logging.info(f"Failed pages: {failed_pages}")
+    frame = frame[~is_header & valid_code].reset_index(drop=True)
+    
+    empty_pages = sorted(set(page_col) - set(frame['Page']))
+    if empty_pages:
+        logging.warning(f"No valid data on pages {empty_pages}")
+        failed_pages.extend(empty_pages)
+    
+    # Only a handful of languages and a few hundred pages; compact dtypes
+    # shrink the frame sent back from the worker
+    frame['Idioma'] = frame['Idioma'].astype('category')
+    frame['Page'] = pd.to_numeric(frame['Page'], downcast='unsigned')
     
-    return df, failed_pages
+    logging.info(f"Processed pages {chunk_start}-{chunk_end} with {len(frame)} rows")
+    
+    # Worker processes exit without running logging's shutdown hooks, so
+    # push buffered records out before handing the chunk back
+    flush_logs()
+    
+    return frame, sorted(set(failed_pages)), failed_rows
+
+INSERT_SQL = '''
+INSERT INTO karaoke_songs
+    (artist, code, title, lyrics_start, language, page_number)
+VALUES (?, ?, ?, ?, ?, ?)
+'''
 
-def save_to_sqlite(df, db_path):
+def insert_batch(conn, batch):
     """
-    Save extracted data to SQLite database with validation
+    Insert a batch in code order so rows land as near-sequential appends
+    to the primary key B-tree
     """
-    logging.info(f"Saving data to {db_path}")
+    batch.sort(key=itemgetter(1))
+    conn.executemany(INSERT_SQL, batch)
+
+# Queue sentinel telling the writer extraction failed; None means it
+# finished normally
+ABORT_LOAD = object()
+
+def db_writer(q, db_path, batch_size=1000):
+    """
+    Drain row batches from the queue into SQLite until the None sentinel
+    arrives, all inside one transaction; ABORT_LOAD rolls the load back
+    and leaves the previous table in place
+    """
+    import sqlite3
     
-    # Ensure data directory exists
-    os.makedirs(os.path.dirname(db_path), exist_ok=True)
+    logging.info(f"Saving data to {db_path}")
     
-    conn = sqlite3.connect(db_path)
+    conn = None
+    drained = False
     
     try:
-        # Create table
+        # Ensure data directory exists
+        os.makedirs(os.path.dirname(db_path), exist_ok=True)
+        
+        conn = sqlite3.connect(db_path, isolation_level=None)
+        
+        # Skip fsyncs and keep the rollback journal in memory for the bulk
+        # load; the journal is still needed to undo an aborted load
+        conn.execute("PRAGMA journal_mode=MEMORY")
+        conn.execute("PRAGMA synchronous=OFF")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-64000")
+        
+        conn.execute("BEGIN")
+        
+        # Recreate the table inside the transaction; the old
+        # to_sql-generated schema may still be around from earlier runs
+        conn.execute("DROP TABLE IF EXISTS karaoke_songs")
         conn.execute('''
-        CREATE TABLE IF NOT EXISTS karaoke_songs (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+        CREATE TABLE karaoke_songs (
+            code TEXT PRIMARY KEY,
             artist TEXT NOT NULL,
-            code TEXT NOT NULL,
             title TEXT NOT NULL,
             lyrics_start TEXT,
             language TEXT,
-            page_number INTEGER,
-            UNIQUE(code)
-        )
+            page_number INTEGER
+        ) WITHOUT ROWID
         ''')
         
-        # Insert data
-        df.to_sql(
-            'karaoke_songs', 
-            conn, 
-            if_exists='replace',
-            index=False,
-            dtype={
-                'Interprete': 'TEXT',
-                'Cod': 'TEXT',
-                'Titulo': 'TEXT',
-                'Inicio da letra': 'TEXT',
-                'Idioma': 'TEXT',
-                'Page': 'INTEGER'
-            }
-        )
+        batch = []
+        
+        while True:
+            rows = q.get()
+            if rows is None or rows is ABORT_LOAD:
+                drained = True
+                break
+            
+            batch.extend(rows)
+            if len(batch) >= batch_size:
+                insert_batch(conn, batch)
+                batch = []
+        
+        if rows is ABORT_LOAD:
+            logging.warning("Extraction failed, keeping the previous database contents")
+            conn.execute("ROLLBACK")
+            return None
+        
+        if batch:
+            insert_batch(conn, batch)
+        
+        conn.execute("COMMIT")
         
         # Verify insertion
         count = conn.execute("SELECT COUNT(*) FROM karaoke_songs").fetchone()[0]
         logging.info(f"Successfully saved {count} rows to database")
         
+        return count
+        
     except Exception as e:
         logging.error(f"Database error: {str(e)}")
+        if conn is not None and conn.in_transaction:
+            conn.execute("ROLLBACK")
+        
+        # Keep draining so the producer never blocks on a full queue
+        while not drained:
+            rows = q.get()
+            drained = rows is None or rows is ABORT_LOAD
         raise
     finally:
-        conn.close()
+        if conn is not None:
+            # Restore durable settings for later readers/writers
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.close()
+
+def extract_to_sqlite(pdf_path, db_path, start_page=1, end_page=None):
+    """
+    Extract karaoke song data from PDF and stream it into SQLite while
+    extraction is still running
+    """
+    from pypdf import PdfReader
+    
+    logging.info(f"Starting extraction from {pdf_path}")
+    
+    extracted_rows = 0
+    total_rows = 0
+    seen_codes = set()
+    failed_pages = []
+    failed_rows = []
+    
+    # If end_page is not specified, try to process all pages
+    if end_page is None:
+        try:
+            # Get total number of pages from the page tree alone, without
+            # laying out any page
+            end_page = len(PdfReader(pdf_path).pages)
+            logging.info(f"Processing {end_page} pages in PDF")
+        except Exception as e:
+            logging.error(f"Error detecting total pages: {str(e)}")
+            end_page = 316
+
+    # Chunks are independent, so spread them across worker processes; each
+    # worker opens and parses its own page range
+    chunk_size = 20
+    ranges = [
+        (chunk_start, min(chunk_start + chunk_size - 1, end_page))
+        for chunk_start in range(start_page, end_page + 1, chunk_size)
+    ]
+    
+    # The debug CSV is opt-in; pyarrow streams it out chunk by chunk
+    write_debug_csv = bool(os.environ.get("KARAOKE_DEBUG_CSV"))
+    debug_csv = '/app/data/extracted_data_debug.csv'
+    debug_writer = None
+    if write_debug_csv:
+        import pyarrow as pa
+        import pyarrow.csv as pac
+        os.makedirs('/app/data', exist_ok=True)
+        
+        # The writer only opens on the first chunk; clear the previous
+        # run's file so a run without rows doesn't leave it looking current
+        if os.path.exists(debug_csv):
+            os.remove(debug_csv)
+    
+    # Bounded queue so extraction can't run arbitrarily far ahead of the
+    # database writer
+    q = queue.Queue(maxsize=32)
+    
+    try:
+        # Forked workers inherit the log buffer; empty it first so
+        # records aren't written once per worker. The writer thread only
+        # starts after the fork, so nothing can log in between
+        flush_logs()
+        
+        with ProcessPoolExecutor(
+            max_workers=min(os.cpu_count() or 1, 6),
+            initializer=_open_worker_pdf,
+            initargs=(pdf_path,)
+        ) as executor:
+            # map submits every chunk up front, which forks all workers
+            # before the writer thread below exists
+            results = executor.map(
+                partial(_extract_chunk, pdf_path),
+                [r[0] for r in ranges],
+                [r[1] for r in ranges]
+            )
+            
+            with ThreadPoolExecutor(max_workers=1) as writer:
+                saved = writer.submit(db_writer, q, db_path)
+                
+                try:
+                    for frame, chunk_failed_pages, chunk_failed_rows in results:
+                        failed_pages.extend(chunk_failed_pages)
+                        failed_rows.extend(chunk_failed_rows)
+                        extracted_rows += len(frame)
+                        
+                        # Rows without a valid code were already split out
+                        # by the worker; drop repeated codes here so the
+                        # primary key never aborts the load
+                        frame = frame[~frame['Cod'].isin(seen_codes)]
+                        frame = frame.drop_duplicates(subset='Cod', keep='first', ignore_index=True)
+                        seen_codes.update(frame['Cod'])
+                        if frame.empty:
+                            continue
+                        
+                        if write_debug_csv:
+                            debug_table = pa.Table.from_pandas(frame, preserve_index=False)
+                            if debug_writer is None:
+                                debug_writer = pac.CSVWriter(debug_csv, debug_table.schema)
+                            debug_writer.write_table(debug_table)
+                        
+                        q.put(list(frame[COLUMNS + ['Page']].itertuples(index=False, name=None)))
+                        total_rows += len(frame)
+                    
+                    if not total_rows:
+                        raise Exception("No data was successfully extracted")
+                    
+                except BaseException:
+                    # Covers Ctrl-C and broken worker pools too; the writer
+                    # must not commit a partial table over the previous one
+                    q.put(ABORT_LOAD)
+                    raise
+                else:
+                    q.put(None)
+                
+                saved.result()
+    finally:
+        if debug_writer is not None:
+            debug_writer.close()
+    
+    # Log summary
+    logging.info(f"Extraction complete:")
+    logging.info(f"Total rows extracted: {extracted_rows + len(failed_rows)}")
+    logging.info(f"Rows without a valid code: {len(failed_rows)}")
+    logging.info(f"Rows with a duplicate code: {extracted_rows - total_rows}")
+    logging.info(f"Rows saved: {total_rows}")
+    logging.info(f"Failed pages: {failed_pages}")
+    
+    return total_rows, failed_pages, failed_rows
 
 def main():
+    setup_logging()
+    
     pdf_path = 'karaoke_list.pdf'
     db_path = '/app/data/karaoke.db'
     
     try:
-        df, failed_pages = extract_karaoke_data(pdf_path)
-        save_to_sqlite(df, db_path)
+        total_rows, failed_pages, failed_rows = extract_to_sqlite(pdf_path, db_path)
         
         # Generate summary file
         with open('/app/data/extraction_summary.txt', 'w') as f:
-            f.write(f"Total songs extracted: {len(df)}\n")
+            f.write(f"Total songs extracted: {total_rows}\n")
             f.write(f"Failed pages: {failed_pages}\n")
+            f.write(f"Failed rows (page, artist, code): {failed_rows}\n")
         
     except Exception as e:
         logging.error(f"Fatal error: {str(e)}")